@@ -10,6 +10,8 @@ import hid # hidapi (requires cython)
 import hashlib
 import struct
 import hmac
+import time
+from collections import OrderedDict
 
 
 # ----------------------------------------------------------------------------------
@@ -21,6 +23,9 @@ usb_report_size = 64 # firmware > v2.0
 report_buf_size = 4096 # firmware v2.0.0
 boot_buf_size_send = 4098
 boot_buf_size_reply = 256
+cmd_buf_size = 3584 # COMMANDER_REPORT_SIZE in firmware (src/flags.h)
+aes_data_len_max = cmd_buf_size * 4 // 7 # AES_DATA_LEN_MAX, limit on decrypted command length
+cmd_array_max = cmd_buf_size - 154 * 8 # COMMANDER_ARRAY_MAX, limit on the sign `data` array
 
 sha256_byte_len = 32
 
@@ -84,6 +89,7 @@ def getHidPath():
 dbb_hid = hid.device()
 def openHid():
     print("\nOpening device")
+    query_cache_reset()
     try:
         dbb_hid.open_path(getHidPath())
         print("\tManufacturer: %s" % dbb_hid.get_manufacturer_string())
@@ -120,6 +126,15 @@ def hid_send_frame(data):
         idx += len(write)
 
 
+def hid_frame_count(data_len):
+    # Number of USB reports hid_send_frame() needs for `data_len` bytes
+    init_len = usb_report_size - 7
+    cont_len = usb_report_size - 5
+    if data_len <= init_len:
+        return 1
+    return 1 + (data_len - init_len + cont_len - 1) // cont_len
+
+
 def hid_read_frame():
     # INIT response
     read = dbb_hid.read(usb_report_size)
@@ -139,9 +154,16 @@ def hid_read_frame():
 
 
 def hid_send_plain(msg):
+    query_cache_note(msg)
+    return hid_send_report(msg)
+
+
+def hid_send_report(msg):
     print("Sending: {}".format(msg))
     if type(msg) == str:
         msg = msg.encode()
+    if len(msg) > cmd_buf_size:
+        print('Warning: command length {} exceeds the firmware buffer ({} bytes)'.format(len(msg), cmd_buf_size))
     reply = ""
     try:
         serial_number = dbb_hid.get_serial_number_string()
@@ -158,15 +180,25 @@ def hid_send_plain(msg):
         print('Exception caught ' + str(e))
     return reply
 
-def hid_send_encrypt(msg, password):
+def hid_send_encrypt(msg, password, bypass_cache=False):
     print("Sending: {}".format(msg))
     reply = ""
+    key = None
+    if not bypass_cache:
+        key = query_cache_key(msg, password)
+        reply = query_cache_get(key)
+        if reply is not None:
+            print("Reply:   {} (cached)\n".format(reply))
+            return reply
+        reply = ""
+    query_cache_note(msg)
+    plain_msg = msg
     try:
         encryption_key, authentication_key = derive_keys(password)
         msg = encrypt_aes(encryption_key, msg)
         hmac_digest = hmac.new(authentication_key, msg, digestmod=hashlib.sha256).digest()
         authenticated_msg = base64.b64encode(msg + hmac_digest)
-        reply = hid_send_plain(authenticated_msg)
+        reply = hid_send_report(authenticated_msg)
         if 'ciphertext' in reply:
             b64_unencoded = bytes(base64.b64decode(''.join(reply["ciphertext"])))
             reply_hmac = b64_unencoded[-sha256_byte_len:]
@@ -179,11 +211,245 @@ def hid_send_encrypt(msg, password):
         if 'error' in reply:
             password = None
             print("\n\nReply:   {}\n\n".format(reply))
+        else:
+            if key is None and not bypass_cache:
+                query_cache_learn_serial(plain_msg, reply)
+                key = query_cache_key(plain_msg, password)
+            query_cache_put(key, reply)
     except Exception as e:
         print('Exception caught ' + str(e))
     return reply
 
 
+# ----------------------------------------------------------------------------------
+# Command builder
+#
+# Compact JSON keeps commands in as few USB reports as possible. An encrypted
+# command grows by the IV, PKCS padding, HMAC, and base64 encoding, so every
+# byte of whitespace saved in the JSON counts.
+#
+
+cmd_led_blink = '{"led":"blink"}'
+cmd_device_info = '{"device":"info"}'
+
+
+def compact_json(obj):
+    return json.dumps(obj, separators=(',', ':'))
+
+
+def build_command(cmd, arg):
+    return compact_json({cmd: arg})
+
+
+def sign_data(items):
+    # `items` is a list of (keypath, hash) tuples
+    return [{'keypath': k, 'hash': h} for k, h in items]
+
+
+def build_sign_command(items, meta='hash'):
+    return build_command('sign', {'meta': meta, 'data': sign_data(items)})
+
+
+def encrypted_len(msg_len):
+    # base64(IV + AES-CBC(msg) + HMAC-SHA256)
+    ct_len = 16 + (msg_len // 16 + 1) * 16 + sha256_byte_len
+    return 4 * ((ct_len + 2) // 3)
+
+
+def command_len(msg, encrypt=True):
+    if type(msg) != bytes and type(msg) != bytearray:
+        msg = msg.encode('utf-8')
+    if encrypt:
+        return encrypted_len(len(msg))
+    return len(msg)
+
+
+def command_frame_count(msg, encrypt=True):
+    return hid_frame_count(command_len(msg, encrypt))
+
+
+def sign_command_fits(items, meta='hash', encrypt=True):
+    # Check the limits the firmware enforces on a sign command: the USB buffer,
+    # the decrypted command length and the length of the `data` array.
+    msg = build_sign_command(items, meta)
+    if command_len(msg, encrypt) > cmd_buf_size:
+        return False
+    if encrypt and command_len(msg, False) > aes_data_len_max:
+        return False
+    return len(compact_json(sign_data(items))) <= cmd_array_max
+
+
+def split_sign_command(items, meta='hash', encrypt=True):
+    # Split a sign request into several commands that each fit the firmware
+    # limits. Every returned command is a separate signing session: each one
+    # needs its own touch button confirmation and, with 2FA enabled, its own
+    # echo round trip to the mobile app. Raises ValueError if a single item
+    # does not fit on its own.
+    commands = []
+    batch = []
+    for item in items:
+        if not sign_command_fits([item], meta, encrypt):
+            raise ValueError('Sign item for keypath {} exceeds the firmware limits'.format(item[0]))
+        if batch and not sign_command_fits(batch + [item], meta, encrypt):
+            commands.append(batch)
+            batch = []
+        batch.append(item)
+    if batch:
+        commands.append(batch)
+    if len(commands) > 1:
+        print('Warning: sign request split into {} commands, each must be confirmed on the device'.format(len(commands)))
+    return [build_sign_command(batch, meta) for batch in commands]
+
+
+# ----------------------------------------------------------------------------------
+# Query cache (opt-in)
+#
+# Replies to read-only commands are cached per device serial and invalidated
+# whenever a command that changes device state is sent to that device.
+#
+
+query_cache_commands = ['device', 'xpub', 'backup']
+query_cache_readonly = ['led', 'random', 'xpub', 'sign', 'ping']
+
+query_cache = None
+query_cache_maxsize = 0
+query_cache_ttl = None
+query_cache_hits = 0
+query_cache_misses = 0
+device_serial = None
+
+
+def enable_query_cache(maxsize=32, ttl=None):
+    global query_cache, query_cache_maxsize, query_cache_ttl
+    query_cache = OrderedDict()
+    query_cache_maxsize = maxsize
+    query_cache_ttl = ttl
+
+
+def disable_query_cache():
+    global query_cache
+    query_cache = None
+
+
+def query_cache_stats():
+    return {'hits': query_cache_hits, 'misses': query_cache_misses,
+            'size': len(query_cache) if query_cache is not None else 0}
+
+
+def query_cache_invalidate(serial=None):
+    if query_cache is None:
+        return
+    for key in list(query_cache.keys()):
+        if serial is None or key[0] == serial:
+            del query_cache[key]
+
+
+def query_cache_reset():
+    # Called when a (possibly different) device is opened
+    global device_serial
+    device_serial = None
+    query_cache_invalidate()
+
+
+def canonical_command(msg):
+    if type(msg) == bytes or type(msg) == bytearray:
+        msg = msg.decode('utf-8', 'replace')
+    try:
+        cmd = json.loads(msg)
+    except ValueError:
+        return None
+    if type(cmd) != dict or len(cmd) != 1:
+        return None
+    return json.dumps(cmd, sort_keys=True, separators=(',', ':'))
+
+
+def is_cacheable_command(cmd):
+    name, arg = list(json.loads(cmd).items())[0]
+    if name == 'device':
+        return arg == 'info'
+    if name == 'backup':
+        return arg == 'list'
+    return name in query_cache_commands
+
+
+def is_mutating_command(cmd):
+    # Anything not known to be read-only is treated as changing device state
+    name, arg = list(json.loads(cmd).items())[0]
+    if name == 'device':
+        return arg != 'info'
+    if name == 'backup':
+        return arg != 'list'
+    if name == 'name':
+        return arg != ''  # an empty name reads the current one
+    return name not in query_cache_readonly
+
+
+def query_cache_learn_serial(msg, reply):
+    # The USB serial number string only holds the firmware version, so the
+    # device serial is taken from the first successful device info reply.
+    # Nothing is cached before that; no extra command is sent to find it,
+    # as every undecryptable command counts toward COMMANDER_MAX_ATTEMPTS.
+    global device_serial
+    if query_cache is None or device_serial is not None:
+        return
+    if canonical_command(msg) != canonical_command(cmd_device_info):
+        return
+    try:
+        device_serial = reply['device']['serial']
+    except (KeyError, TypeError):
+        pass
+
+
+def query_cache_key(msg, password):
+    if query_cache is None or device_serial is None:
+        return None
+    cmd = canonical_command(msg)
+    if cmd is None or not is_cacheable_command(cmd):
+        return None
+    serial = device_serial
+    # The password is part of the key so a cached reply is never returned
+    # for a password the device has not accepted.
+    return (serial, cmd, sha256(password.encode('utf-8')))
+
+
+def query_cache_get(key):
+    global query_cache_hits, query_cache_misses
+    if key is None:
+        return None
+    entry = query_cache.get(key)
+    if entry is not None and query_cache_ttl is not None and time.time() - entry[0] > query_cache_ttl:
+        del query_cache[key]
+        entry = None
+    if entry is None:
+        query_cache_misses += 1
+        return None
+    query_cache_hits += 1
+    del query_cache[key]
+    query_cache[key] = entry  # mark as most recently used
+    return json.loads(entry[1])  # a fresh object, so callers cannot modify the cache
+
+
+def query_cache_put(key, reply):
+    if key is None or query_cache is None or type(reply) != dict:
+        return
+    query_cache[key] = (time.time(), compact_json(reply))
+    while len(query_cache) > query_cache_maxsize:
+        query_cache.popitem(last=False)
+
+
+def query_cache_note(msg):
+    # Invalidate cached replies for this device if `msg` changes device state
+    if query_cache is None:
+        return
+    cmd = canonical_command(msg)
+    if cmd is None or not is_mutating_command(cmd):
+        return
+    if device_serial is None:
+        query_cache_invalidate()
+    else:
+        query_cache_invalidate(device_serial)
+
+
 # ----------------------------------------------------------------------------------
 # Bootloader io
 #
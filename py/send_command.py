@@ -20,17 +20,18 @@ try:
 
     # Example JSON commands - refer to digitalbitbox.com/api
     message = '{"backup":"list"}'
-    message = '{"device":"info"}'
+    message = cmd_device_info
     message = '{"random":"pseudo"}'
     message = '{"bootloader":"lock"}'
     message = '{"bootloader":"unlock"}'
     message = '{"feature_set":{"U2F":false}}'
     message = '{"seed":{"source":"create", "filename":"testing.pdf", "key":"password"}}'
-    message = '{"sign":{"meta":"hash", "data":[{"keypath":"m/1p/1/1/0", "hash":"0123456789abcdef0123456789abcdef0123456789abcdef0123456789abcdef"},{"keypath":"m/1p/1/1/1", "hash":"123456789abcdef0123456789abcdef0123456789abcdef0123456789abcdef0"}]}}'
-    message = '{"led":"blink"}'
+    message = build_sign_command([("m/1p/1/1/0", "0123456789abcdef0123456789abcdef0123456789abcdef0123456789abcdef"), ("m/1p/1/1/1", "123456789abcdef0123456789abcdef0123456789abcdef0123456789abcdef0")])
+    message = cmd_led_blink
 
 
     # Send a JSON command
+    print("USB frames: {}".format(command_frame_count(message)))
     hid_send_encrypt(message, password)
 
 